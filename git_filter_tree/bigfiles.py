@@ -0,0 +1,106 @@
+"""
+History rewrite helper script: Remove large files from history
+
+Usage:
+    git-filter-tree bigfiles SIZE [MODE] [-- REFS]
+
+Arguments:
+
+    SIZE        Blobs larger than SIZE bytes are removed. Accepts the
+                suffixes k, M, G (powers of 1024).
+    MODE        "remove" to delete the files, or "stub" to replace their
+                content by a short note with the SHA1 and size of the
+                original blob                           [default: remove]
+    REFS        git-rev-list options
+
+Blob sizes are determined from the object headers only (including packed
+objects), so blob contents are never read. All removed blobs are listed in
+$GIT_DIR/bigfiles-report as lines "SHA1 SIZE PATH", where PATH is the first
+location the blob was found at.
+"""
+
+from .tree_filter import TreeFilter, cached, content_cached
+
+from subprocess import Popen, PIPE, CalledProcessError
+import os
+
+
+SUFFIXES = {'k': 1024, 'M': 1024**2, 'G': 1024**3}
+
+STUB = """\
+This file was removed from the history because it was too large.
+
+oid {}
+size {}
+"""
+
+
+def parse_size(size):
+    factor = SUFFIXES.get(size[-1:], 1)
+    if factor != 1:
+        size = size[:-1]
+    return int(size) * factor
+
+
+def large_blobs(limit):
+    """Return ``{sha1: size}`` of all blobs larger than ``limit``. Only
+    object headers are read."""
+    args = [
+        'git', 'cat-file', '--batch-all-objects',
+        '--batch-check=%(objecttype) %(objectsize) %(objectname)',
+    ]
+    proc = Popen(args, stdout=PIPE)
+    result = {}
+    for line in proc.stdout:
+        kind, size, sha1 = line.split()
+        if kind == b'blob' and int(size) > limit:
+            result[sha1.decode('ascii')] = int(size)
+    if proc.wait():
+        raise CalledProcessError(proc.returncode, args)
+    return result
+
+
+class BigFiles(TreeFilter):
+
+    def __init__(self, size, mode='remove'):
+        super().__init__()
+        if mode not in ('remove', 'stub'):
+            raise ValueError("Unknown mode: {}".format(mode))
+        self.stub = mode == 'stub'
+        self.report_path = os.path.join(self.gitdir, 'bigfiles-report')
+        self.reported = set()
+        self.large = large_blobs(parse_size(size))
+
+    # rewrite depends only on the object payload and name:
+    def depends(self, obj):
+        return (obj.sha1, obj.name, obj.mode)
+
+    async def filter(self, objs, refs):
+        # keep the report of a rewrite that is still in progress:
+        if os.path.exists(self.objmap):
+            return await super().filter(objs, refs)
+        with open(self.report_path, 'wt') as self.report:
+            return await super().filter(objs, refs)
+
+    @cached
+    async def rewrite_file(self, obj):
+        mode, kind, sha1, name = obj
+        size = self.large.get(sha1)
+        if size is None:
+            return [obj[:]]
+        if sha1 not in self.reported:
+            self.reported.add(sha1)
+            self.report.write('{} {} {}\n'.format(sha1, size, obj.path))
+        if not self.stub:
+            return []
+        sha1 = await self.stub_blob(sha1, size)
+        return [(mode, kind, sha1, name)]
+
+    @content_cached
+    async def stub_blob(self, sha1, size):
+        return await self.write_blob(STUB.format(sha1, size).encode('utf-8'))
+
+
+main = BigFiles.main
+if __name__ == '__main__':
+    import sys; sys.exit(main())
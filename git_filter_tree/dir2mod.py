@@ -53,13 +53,16 @@ class Dir2Mod(TreeFilter):
             ).encode('utf-8'))
         return [(mode, kind, sha1, name)]
 
+    # only recurse into `self.path`:
+    def should_descend(self, path):
+        return not path or self.path.startswith(path + '/')
+
     @cached
     async def rewrite_tree(self, obj):
         if obj.path == self.path:
             commit = self.commit_for_tree[obj.sha1]
             return [(0o160000, 'commit', commit, obj.name, True)]
-        # only recurse into `self.path`:
-        elif not obj.path or self.path.startswith(obj.path + '/'):
+        elif self.should_descend(obj.path):
 
             old_entries = await self.read_tree(obj.sha1)
             new_entries = await self.map_tree(obj, old_entries)
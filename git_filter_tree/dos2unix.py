@@ -11,7 +11,8 @@ Arguments:
     REFS        git-rev-list options
 """
 
-from .tree_filter import TreeFilter, cached
+from .tree_filter import TreeFilter, cached, content_cached
+from .tree_index import ext_key
 
 import os
 import re
@@ -28,17 +29,23 @@ class Dos2Unix(TreeFilter):
     def depends(self, obj):
         return (obj.sha1, obj.name, obj.mode)
 
+    def index_keys(self):
+        if self.ext.startswith('.'):
+            return [ext_key(self.ext)]
+        return None
+
     @cached
     async def rewrite_file(self, obj):
         mode, kind, sha1, name = obj
         if name.endswith(self.ext):
-            sha1 = await self.convertToUnix(obj)
+            sha1 = await self.convertToUnix(sha1)
         return [(mode, kind, sha1, name)]
 
-    async def convertToUnix(self, obj):
-        text = await self.read_blob(obj.sha1)
+    @content_cached
+    async def convertToUnix(self, sha1):
+        text = await self.read_blob(sha1)
         if not text or text.endswith(b'\n') and not text.endswith(b'\n\n') and not TRAILING_WS.search(text):
-            return obj.sha1
+            return sha1
         lines = text.splitlines()
         while len(lines) > 0 and lines[-1].rstrip() == b"":
             lines.pop()
@@ -0,0 +1,43 @@
+"""
+Build the tree index that allows later rewrites to skip unaffected subtrees.
+
+Usage:
+    git-filter-tree index [-- REFS]
+
+Arguments:
+
+    REFS        git-rev-list options
+
+The index is stored in $GIT_DIR/tree-index and is also updated by all
+filters that support it, so running this beforehand is optional.
+"""
+
+from .tree_filter import TreeFilter
+from .tree_index import TreeIndex
+
+from contextlib import ExitStack
+import os
+
+
+class Index(TreeFilter):
+
+    def depends(self, obj):
+        return obj[:]
+
+    def open_tree_index(self):
+        return TreeIndex(self.index_path)
+
+    async def rewrite_file(self, obj):
+        return [obj[:]]
+
+    async def filter(self, objs, refs):
+        with ExitStack() as stack:
+            self.objmap_file = stack.enter_context(open(os.devnull, 'wt'))
+            self.tree_index = stack.enter_context(self.open_tree_index())
+            self.open_progress_file(stack)
+            return await self.filter_tree(objs)
+
+
+main = Index.main
+if __name__ == '__main__':
+    import sys; sys.exit(main())
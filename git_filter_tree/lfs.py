@@ -0,0 +1,156 @@
+"""
+History rewrite helper script: Convert files to Git LFS pointers
+
+Usage:
+    git-filter-tree lfs PATTERN [PATTERN...] [-- REFS]
+
+Arguments:
+
+    PATTERN     Filename pattern as in .gitattributes, e.g. `*.psd`. Patterns
+                without a slash match the file name in any directory, others
+                the path relative to the repository root, one component at
+                a time (`*` doesn't match `/`, `**` matches any number of
+                directories).
+    REFS        git-rev-list options
+
+The contents of matching files are stored in $GIT_DIR/lfs/objects and the
+blobs are replaced by LFS pointer files. The patterns are added to the
+top-level .gitattributes file.
+"""
+
+from .tree_filter import TreeFilter, cached, content_cached
+from .tree_index import name_key, ext_key
+from .path_matcher import PathMatcher, has_magic
+
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatchcase
+from subprocess import Popen, PIPE, CalledProcessError
+import hashlib
+import os
+import tempfile
+
+
+CHUNK_SIZE = 1024 * 1024
+
+POINTER = """\
+version https://git-lfs.github.com/spec/v1
+oid sha256:{}
+size {}
+"""
+
+
+def store_lfs_object(repo, sha1):
+    """Stream a blob into the LFS object store and return the SHA1 of the
+    pointer blob. Hashing and writing of chunks is overlapped."""
+    gitdir = repo.path
+    objects = os.path.join(gitdir, 'lfs', 'objects')
+    tmpdir = os.path.join(gitdir, 'lfs', 'tmp')
+    os.makedirs(tmpdir, exist_ok=True)
+    args = ['git', '--git-dir', gitdir, 'cat-file', 'blob', sha1]
+    digest = hashlib.sha256()
+    size = 0
+    head = b''
+    f = tempfile.NamedTemporaryFile(dir=tmpdir, delete=False)
+    try:
+        with f, Popen(args, stdout=PIPE) as proc, \
+                ThreadPoolExecutor(1) as writer:
+            write = None
+            for chunk in iter(lambda: proc.stdout.read(CHUNK_SIZE), b''):
+                # keep one write in flight while hashing and reading ahead:
+                if write is not None:
+                    write.result()
+                write = writer.submit(f.write, chunk)
+                digest.update(chunk)
+                head = head or chunk[:1024]
+                size += len(chunk)
+            if write is not None:
+                write.result()
+        if proc.returncode:
+            raise CalledProcessError(proc.returncode, args)
+    except BaseException:
+        os.remove(f.name)
+        raise
+    # leave existing pointers alone:
+    if size < 1024 and head.startswith(POINTER.split('\n')[0].encode('ascii')):
+        os.remove(f.name)
+        return sha1
+    oid = digest.hexdigest()
+    path = os.path.join(objects, oid[0:2], oid[2:4], oid)
+    if os.path.exists(path):
+        os.remove(f.name)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(f.name, path)
+    return repo.create_blob(POINTER.format(oid, size).encode('ascii')).hex
+
+
+class LFS(TreeFilter):
+
+    def __init__(self, *patterns):
+        super().__init__()
+        self.patterns = [p.lstrip('/') if '/' in p else p for p in patterns]
+        self.by_name = not any('/' in p for p in patterns)
+        self.names = [p for p in self.patterns if '/' not in p]
+        self.paths = PathMatcher([p for p in self.patterns if '/' in p],
+                                 recursive=False)
+        self.attributes = ['{} filter=lfs diff=lfs merge=lfs -text'.format(p)
+                           for p in patterns]
+
+    # rewrite depends only on the name, unless patterns contain paths:
+    def depends(self, obj):
+        return (obj.sha1, obj.name if self.by_name else obj.path, obj.mode)
+
+    def index_keys(self):
+        if not self.by_name:
+            return None
+        keys = []
+        for pattern in self.patterns:
+            if not has_magic(pattern):
+                keys.append(name_key(pattern))
+            elif pattern.startswith('*.') and not has_magic(pattern[1:]):
+                keys.append(ext_key(pattern[1:]))
+            else:
+                return None
+        return keys
+
+    def matches(self, obj):
+        return (any(fnmatchcase(obj.name, p) for p in self.names) or
+                not self.by_name and self.paths.match(obj.path))
+
+    @cached
+    async def rewrite_file(self, obj):
+        mode, kind, sha1, name = obj
+        if mode in (0o100644, 0o100755) and self.matches(obj):
+            sha1 = await self.convert(sha1)
+        return [(mode, kind, sha1, name)]
+
+    @content_cached
+    async def convert(self, sha1):
+        return await self.run_in_executor(store_lfs_object, self.repo, sha1)
+
+    async def rewrite_tree(self, obj):
+        if obj.path:
+            return await super().rewrite_tree(obj)
+        # add the patterns to the top-level .gitattributes:
+        entries = await self.map_tree(obj, await self.read_tree(obj.sha1))
+        i = next((i for i, e in enumerate(entries)
+                  if e[3] == '.gitattributes'), None)
+        if i is None:
+            entries.append(await self.gitattributes_file(None))
+        else:
+            entries[i] = await self.gitattributes_file(entries[i][2])
+        sha1 = await self.write_tree(entries)
+        return [(obj.mode, obj.kind, sha1, obj.name)]
+
+    @cached
+    async def gitattributes_file(self, sha1):
+        text = sha1 and await self.read_blob(sha1) or b""
+        lines = text.decode('utf-8').splitlines()
+        lines += [line for line in self.attributes if line not in lines]
+        sha1 = await self.write_blob(("\n".join(lines) + "\n").encode('utf-8'))
+        return (0o100644, 'blob', sha1, '.gitattributes')
+
+
+main = LFS.main
+if __name__ == '__main__':
+    import sys; sys.exit(main())
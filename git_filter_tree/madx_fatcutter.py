@@ -4,7 +4,8 @@ Module used for the MAD-X migration from SVN to git.
 Combines `unpack` and `rm` filter with one exception for unpacking.
 """
 
-from git_filter_tree.tree_filter import TreeFilter, cached
+from git_filter_tree.tree_filter import TreeFilter, cached, content_cached
+from git_filter_tree.tree_index import name_key, ext_key
 
 import os
 
@@ -38,6 +39,10 @@ class FatCutter(TreeFilter):
     def depends(self, obj):
         return (obj.sha1, obj.path, obj.mode)
 
+    def index_keys(self):
+        return [ext_key(EXT), name_key('.gitattributes')] + [
+            name_key(os.path.basename(path)) for path in REMOVE]
+
     @cached
     async def rewrite_file(self, obj):
         if obj.path in REMOVE:
@@ -53,10 +58,14 @@ class FatCutter(TreeFilter):
             ).encode('utf-8'))
         elif shall_extract(obj.path):
             name, ext = os.path.splitext(name)
-            sha1 = await self.run_in_executor(extract, sha1)
+            sha1 = await self.unpack_blob(sha1)
 
         return [(mode, kind, sha1, name)]
 
+    @content_cached
+    async def unpack_blob(self, sha1):
+        return await self.run_in_executor(extract, sha1)
+
 
 def fix_gitattr_line(line):
     name, attr = line.split(' ', 1)
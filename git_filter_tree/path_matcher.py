@@ -0,0 +1,101 @@
+"""
+Match paths against many patterns at once using a trie of path components.
+
+Patterns are ``/``-separated paths relative to the repository root. Each
+component may contain ``fnmatch`` style wildcards (``*``, ``?``, ``[...]``),
+and a ``**`` component matches any number of directories. A pattern matching
+a directory matches everything inside it as well, unless the matcher is
+created with ``recursive=False`` (as for ``.gitattributes`` patterns).
+
+Paths are matched one component at a time, so that a tree traversal can stop
+descending into directories that no pattern can match.
+"""
+
+from fnmatch import fnmatchcase
+
+
+def has_magic(part):
+    return any(c in part for c in '*?[')
+
+
+class Node:
+
+    __slots__ = ('children', 'globs', 'star', 'loop', 'terminal')
+
+    def __init__(self, loop=False):
+        self.children = {}      # literal name -> Node
+        self.globs = {}         # glob pattern -> Node
+        self.star = None        # Node for a following `**`
+        self.loop = loop        # this is a `**` node
+        self.terminal = False   # a pattern ends here
+
+
+class PathMatcher:
+
+    """
+    Compiled set of path patterns.
+
+    The state for a path is the set of trie nodes reached by it. An empty
+    state means that neither the path nor anything below it can match.
+    """
+
+    def __init__(self, patterns, recursive=True):
+        self.recursive = recursive
+        self.root = Node()
+        for pattern in patterns:
+            node = self.root
+            for part in pattern.strip('/').split('/'):
+                if part == '**':
+                    if node.star is None:
+                        node.star = Node(loop=True)
+                    node = node.star
+                elif has_magic(part):
+                    node = node.globs.setdefault(part, Node())
+                else:
+                    node = node.children.setdefault(part, Node())
+            node.terminal = True
+        self._states = {'': self._closure([self.root])}
+
+    def state(self, path):
+        """Return the state for a directory path (memoized)."""
+        state = self._states.get(path)
+        if state is None:
+            parent, _, name = path.rpartition('/')
+            state = self._states[path] = self.step(self.state(parent), name)
+        return state
+
+    def step(self, state, name):
+        """Return the state for the child ``name`` of a path in ``state``."""
+        nodes = []
+        for node in state:
+            # everything below a match is matched as well:
+            if node.loop or (node.terminal and self.recursive):
+                nodes.append(node)
+            child = node.children.get(name)
+            if child is not None:
+                nodes.append(child)
+            nodes.extend(child for glob, child in node.globs.items()
+                         if fnmatchcase(name, glob))
+        return self._closure(nodes)
+
+    def match(self, path):
+        """Check if the path (or one of its parents) matches a pattern. Only
+        the states of the parent directories are memoized, so that matching
+        all files of a history doesn't fill up the memory."""
+        if not path:
+            return self.matched(self.state(path))
+        parent, _, name = path.rpartition('/')
+        return self.matched(self.step(self.state(parent), name))
+
+    @staticmethod
+    def matched(state):
+        return any(node.terminal for node in state)
+
+    @staticmethod
+    def _closure(nodes):
+        result = set()
+        for node in nodes:
+            while node is not None and node not in result:
+                result.add(node)
+                node = node.star
+        return frozenset(result)
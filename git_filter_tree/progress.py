@@ -0,0 +1,162 @@
+"""
+Progress reporting for tree rewrites.
+
+The ETA is estimated from the number of unique objects that still need to be
+rewritten rather than from the number of remaining roots: later roots mostly
+consist of cache hits and are much cheaper than the first ones. The number of
+objects that remaining roots will add is extrapolated from the recent roots.
+
+Progress is rendered either as a (rate limited) status line for terminals, or
+as a stream of JSON objects, one per line, for logs and other programs. By
+default, the status line is written to stdout and JSON events to stderr, so
+they don't interleave with the regular output.
+"""
+
+import json
+import math
+import sys
+import time
+from collections import deque
+
+
+# smoothing factor for the number of new objects per root:
+ALPHA = 0.1
+# the rate is computed from the progress during this many seconds:
+RATE_WINDOW = 30
+
+
+def time_to_str(seconds):
+    return time.strftime('%H:%M:%S', time.gmtime(math.ceil(seconds)))
+
+
+class TTYRenderer:
+
+    interval = 0.1
+
+    def __init__(self, stream=None):
+        self.stream = stream
+
+    def __call__(self, event, state):
+        if event == 'start':
+            return
+        stream = self.stream or sys.stdout
+        eta = state['eta']
+        stream.write(
+            '\r\033[K{roots_done} / {roots_total} roots, {objects_done} objects'
+            ' rewritten ({rate:.1f} objs/sec) in {elapsed}, ETA: {eta}'.format_map(
+                dict(state, elapsed=time_to_str(state['elapsed']),
+                     eta=time_to_str(eta) if eta is not None else '?')))
+        if event == 'finish':
+            stream.write('\n')
+        stream.flush()
+
+
+class JSONRenderer:
+
+    interval = 10
+
+    def __init__(self, stream=None):
+        self.stream = stream
+
+    def __call__(self, event, state):
+        stream = self.stream or sys.stderr
+        stream.write(json.dumps(dict(state, event=event)) + '\n')
+        stream.flush()
+
+
+RENDERERS = {
+    'tty': TTYRenderer,
+    'json': JSONRenderer,
+}
+
+
+def renderer_name(name):
+    """Check the name of a renderer, see :func:`make_renderer`."""
+    if name not in ('auto', 'none') and name not in RENDERERS:
+        raise ValueError("Unknown progress renderer: {}".format(name))
+    return name
+
+
+def make_renderer(name, stream=None):
+    """Create renderer by name: 'tty', 'json', 'auto' or 'none'. Without
+    ``stream``, the renderers use the current stdout or stderr."""
+    if name == 'none':
+        return None
+    if name == 'auto':
+        name = 'tty' if (stream or sys.stdout).isatty() else 'json'
+    try:
+        return RENDERERS[name](stream)
+    except KeyError:
+        raise ValueError("Unknown progress renderer: {}".format(name))
+
+
+class Progress:
+
+    """
+    Tracks the progress of an :class:`AsyncQueue` of roots.
+
+    ``stats`` is the ``cache_stats`` counter of the filter; ``key`` names the
+    cached function whose unique calls are counted as objects.
+    """
+
+    def __init__(self, renderer, stats, phase, key='rewrite_object',
+                 interval=None):
+        self.renderer = renderer
+        self.stats = stats
+        self.phase = phase
+        self.key = key
+        self.interval = renderer and (
+            renderer.interval if interval is None else interval)
+
+    def start(self, total):
+        self.start_time = self.last_time = time.time()
+        self.samples = deque([(self.start_time, self.stats[self.key, 'done'])])
+        self.per_root = 0.0
+        self.num_roots = 0
+        self.last_started = self.stats[self.key, 'misses']
+        self.total = total
+        self.emit('start', None)
+
+    def update(self, queue):
+        started = self.stats[self.key, 'misses']
+        new = started - self.last_started
+        self.last_started = started
+        # running mean for the first roots, moving average afterwards:
+        self.num_roots += 1
+        self.per_root += max(ALPHA, 1 / self.num_roots) * (new - self.per_root)
+        now = time.time()
+        if self.renderer and now - self.last_time >= self.interval:
+            self.last_time = now
+            self.emit('progress', queue)
+
+    def finish(self, queue):
+        self.emit('finish', queue)
+
+    def emit(self, event, queue):
+        if self.renderer is not None:
+            self.renderer(event, self.state(queue))
+
+    def state(self, queue):
+        now = time.time()
+        started = self.stats[self.key, 'misses']
+        done = self.stats[self.key, 'done']
+        samples = self.samples
+        samples.append((now, done))
+        while len(samples) > 2 and samples[1][0] < now - RATE_WINDOW:
+            samples.popleft()
+        (t0, done0) = samples[0]
+        rate = (done - done0) / (now - t0) if now > t0 else 0.0
+        roots_done = queue.num_done if queue is not None else 0
+        roots_pending = queue.num_pending if queue is not None else self.total
+        remaining = (started - done) + self.per_root * roots_pending
+        return {
+            'phase': self.phase,
+            'roots_done': roots_done,
+            'roots_total': self.total,
+            'objects_done': done,
+            'objects_active': started - done,
+            'objects_remaining': int(remaining),
+            'elapsed': now - self.start_time,
+            'rate': rate,
+            'eta': remaining / rate if rate else None,
+        }
@@ -1,41 +1,80 @@
 """
-History rewrite helper script: Remove specific files (not dirs)
+History rewrite helper script: Remove files and directories
 
 Usage:
     git-filter-tree rm PATH [PATH...] [-- REFS]
 
 Arguments:
 
-    PATH        Absolute filename within the repository
+    PATH        Path within the repository, relative to its root. Can be a
+                file or directory. Components may contain wildcards (`*`,
+                `?`, `[...]`), and `**` matches any number of directories,
+                e.g. `**/*.pem` or `vendor/**/node_modules`.
 """
 
 from .tree_filter import TreeFilter, cached
+from .tree_index import name_key
+from .path_matcher import PathMatcher, has_magic
+
+import os
 
 
 class Rm(TreeFilter):
 
-    def __init__(self, *files):
+    def __init__(self, *patterns):
         super().__init__()
-        self.files = set(files)
+        self.patterns = patterns
+        self.matcher = PathMatcher(patterns)
+        # the root tree can't be removed, fail before touching the repo:
+        for pattern in patterns:
+            if not pattern.strip('/') or PathMatcher([pattern]).match(''):
+                raise ValueError(
+                    "Pattern matches the repository root: {!r}".format(
+                        pattern))
 
-    # rewrite depends only on the object payload and name:
+    # rewrite depends on the location:
     def depends(self, obj):
-        return (obj.sha1, obj.name, obj.mode)
+        return (obj.sha1, obj.path, obj.mode)
+
+    def index_keys(self):
+        names = [os.path.basename(p.rstrip('/')) for p in self.patterns]
+        if any(has_magic(name) for name in names):
+            return None
+        return [name_key(name) for name in names + ['.gitattributes']]
+
+    # don't descend into directories that can't contain any match:
+    def should_descend(self, path):
+        state = self.matcher.state(path)
+        return bool(state) and not self.matcher.matched(state)
+
+    async def rewrite_tree(self, obj):
+        if self.matcher.match(obj.path):
+            return []
+        return await super().rewrite_tree(obj)
 
     @cached
     async def rewrite_file(self, obj):
         mode, kind, sha1, name = obj
-        if obj.path in self.files:
+        if self.matcher.match(obj.path):
             return []
         if name == '.gitattributes':
             text = obj.sha1 and await self.read_blob(obj.sha1) or b""
-            sha1 = await self.write_blob("\n".join(
-                line for line in text.decode('utf-8').splitlines()
-                for name, attr in [line.split(' ', 1)]
-                if name not in self.files
-            ).encode('utf-8'))
+            lines = text.decode('utf-8').splitlines()
+            kept = [line for line in lines
+                    if not self.removes_attr(obj.path, line)]
+            if kept != lines:
+                sha1 = await self.write_blob("\n".join(kept).encode('utf-8'))
         return [(mode, kind, sha1, name)]
 
+    def removes_attr(self, path, line):
+        """Check if a line in the .gitattributes at ``path`` refers to a
+        removed path."""
+        if not line.strip() or line.lstrip().startswith('#'):
+            return False
+        pattern = line.split(None, 1)[0].lstrip('/')
+        folder = os.path.dirname(path)
+        return self.matcher.match(folder and folder + '/' + pattern or pattern)
+
 
 main = Rm.main
 if __name__ == '__main__':
@@ -3,20 +3,24 @@ Utility module for git tree-rewrites.
 """
 
 import multiprocessing
+import json
 import os
 import sys
-import math
-import time
 
 import asyncio
 from concurrent.futures import ProcessPoolExecutor
 
-from collections import namedtuple
-from subprocess import Popen, PIPE
-from itertools import chain
+from collections import namedtuple, defaultdict, Counter, OrderedDict
+from contextlib import ExitStack
+from fnmatch import fnmatchcase
+from subprocess import Popen, PIPE, CalledProcessError
+from itertools import chain, islice
 
 import pygit2
 
+from .tree_index import TreeIndex
+from .progress import Progress, TTYRenderer, make_renderer, renderer_name
+
 
 DISPATCH = {
     'blob': 'rewrite_file',
@@ -24,6 +28,25 @@ DISPATCH = {
     'commit': 'rewrite_commit',
 }
 
+# `git rev-list` options that select refs by namespace:
+REF_NAMESPACES = {
+    '--branches': 'refs/heads/',
+    '--tags': 'refs/tags/',
+    '--remotes': 'refs/remotes/',
+    '--glob': 'refs/',
+}
+
+# lookup order for short ref names, see git-rev-parse(1):
+REF_PREFIXES = ['', 'refs/', 'refs/tags/', 'refs/heads/', 'refs/remotes/']
+
+# lines that start the signature of a tag (OpenPGP, SSH or X.509):
+SIGNATURE_MARKERS = (
+    b'-----BEGIN PGP SIGNATURE-----',
+    b'-----BEGIN PGP MESSAGE-----',
+    b'-----BEGIN SSH SIGNATURE-----',
+    b'-----BEGIN SIGNED MESSAGE-----',
+)
+
 
 class Repository:
 
@@ -38,6 +61,9 @@ class Repository:
     def __getitem__(self, key):
         return self._repo[key]
 
+    def __contains__(self, key):
+        return key in self._repo
+
     def __getstate__(self):
         return self._repo.path
 
@@ -69,6 +95,7 @@ class AsyncQueue:
         self.jobs = ()
         self.size = size
         self.done = asyncio.Event()
+        self.progress = asyncio.Event()
         self.num_pending = 0
         self.num_active = 0
         self.num_total = 0
@@ -81,11 +108,16 @@ class AsyncQueue:
         self.jobs = chain.from_iterable((self.jobs, jobs))
         for _ in range(self.size - self.num_active):
             self._start()
+        if not self.num_active:
+            self.done.set()
         return self
 
+    def _next(self):
+        return next(self.jobs)
+
     def _start(self):
         try:
-            job = next(self.jobs)
+            job = self._next()
         except StopIteration:
             return
         future = asyncio.ensure_future(job)
@@ -99,6 +131,7 @@ class AsyncQueue:
         self._start()
         if not self.num_active:
             self.done.set()
+        self.progress.set()
         self.status_callback(self)
 
     def __await__(self):
@@ -111,22 +144,107 @@ class AsyncQueue:
         await self.done.wait()
 
 
-async def process_objects(size, func, objs):
-
-    start = time.time()
-    def status(queue):
-        done, pending = queue.num_done, queue.num_total
-        passed = time.time() - start
-        rate = passed / done
-        eta = (pending - done) * rate
-        print('\r\033[K{} / {} objects rewritten ({:.1f} objs/sec) in {}, ETA: {}'
-                .format(done, pending, 1 / rate,
-                        time_to_str(passed), time_to_str(eta)),
-                end='')
-        sys.stdout.flush()
-
-    queue = AsyncQueue(size, status)
-    await queue.enqueue(len(objs), map(func, objs))
+class PriorityQueue(AsyncQueue):
+
+    """AsyncQueue that is fed with objects instead of coroutines. From the
+    next ``window`` pending objects it starts ``func(obj)`` for the one with
+    the highest ``scorer.score(obj)`` and then informs ``scorer.started``."""
+
+    def __init__(self, size, cb, func, scorer, window):
+        super().__init__(size, cb)
+        self.func = func
+        self.scorer = scorer
+        self.window = []
+        self.window_size = window
+
+    def _next(self):
+        self.window.extend(
+            islice(self.jobs, self.window_size - len(self.window)))
+        if not self.window:
+            raise StopIteration
+        scores = list(map(self.scorer.score, self.window))
+        obj = self.window.pop(scores.index(max(scores)))
+        self.scorer.started(obj)
+        return self.func(obj)
+
+
+class Locality:
+
+    """Score roots by the number of top-level objects that they share with
+    the most recently started roots."""
+
+    def __init__(self, repo, memory=4096):
+        self.repo = repo
+        self.memory = memory
+        self.recent = OrderedDict()
+        self.entries = {}
+
+    def score(self, sha1):
+        recent = self.recent
+        return sum(oid in recent for oid in self._entries(sha1))
+
+    def started(self, sha1):
+        recent = self.recent
+        for oid in self._entries(sha1):
+            recent[oid] = None
+            recent.move_to_end(oid)
+        del self.entries[sha1]
+        while len(recent) > self.memory:
+            recent.popitem(last=False)
+
+    def _entries(self, sha1):
+        if sha1 not in self.entries:
+            obj = self.repo[sha1.strip()]
+            if obj.type == pygit2.GIT_OBJ_COMMIT:
+                obj = obj.tree
+            self.entries[sha1] = ([obj.hex] + [e.id.hex for e in obj]
+                                  if obj.type == pygit2.GIT_OBJ_TREE else [])
+        return self.entries[sha1]
+
+
+class ObjectCache:
+
+    """Bounded LRU cache for decoded objects."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key):
+        value = self.data.get(key)
+        if value is not None:
+            self.data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+
+async def process_objects(size, func, objs, scorer=None, window=0,
+                          prefetch=None, progress=None):
+
+    if progress is None:
+        progress = Progress(TTYRenderer(), Counter(), '')
+    progress.start(len(objs))
+    if scorer is None:
+        queue = AsyncQueue(size, progress.update)
+        queue.enqueue(len(objs), map(func, objs))
+    else:
+        queue = PriorityQueue(size, progress.update, func, scorer, window)
+        queue.enqueue(len(objs), iter(objs))
+    if prefetch is not None:
+        task = asyncio.ensure_future(prefetch(queue, objs))
+    await queue
+    # prefetching is only an optimization, so don't fail if it did:
+    if prefetch is not None and not task.cancel() and task.exception():
+        print("WARNING: Prefetching failed: {!r}".format(task.exception()))
+    progress.finish(queue)
 
 
 class DirEntry(namedtuple('DirEntry', ['mode', 'kind', 'sha1', 'name'])):
@@ -153,10 +271,22 @@ def communicate(args, text=None):
 
 def read_tree(repo, sha1):
     """Iterate over tuples (mode, kind, sha1, name)."""
-    return [(e.filemode, e.type, e.id.hex, e.name)
+    return [(e.filemode, entry_kind(e), e.id.hex, e.name)
             for e in repo[sha1]]
 
 
+def entry_kind(entry):
+    """Return the kind of a tree entry as string ('tree', 'blob', …)."""
+    # NOTE: pygit2≥0.28 returns an int for `.type` and the string as
+    # `.type_str`, older versions only have the string `.type`:
+    return getattr(entry, 'type_str', entry.type)
+
+
+def read_trees(repo, sha1s):
+    """Read multiple trees at once, see :func:`read_tree`."""
+    return [read_tree(repo, sha1) for sha1 in sha1s]
+
+
 def write_tree(repo, entries):
     """Create a tree and return the hash."""
     builder = repo.TreeBuilder()
@@ -166,6 +296,18 @@ def write_tree(repo, entries):
     return builder.write().hex
 
 
+def update_tree(repo, base, removed, added):
+    """Create a tree from ``base`` with the ``removed`` names deleted and the
+    ``added`` entries inserted, and return the hash."""
+    builder = repo.TreeBuilder(repo[base])
+    for name in removed:
+        builder.remove(name)
+    for e in added:
+        mode, kind, sha1, name = e[:4]
+        builder.insert(name, sha1, mode)
+    return builder.write().hex
+
+
 def read_blob(repo, sha1):
     return repo[sha1].data
 
@@ -179,19 +321,272 @@ def create_commit(repo, author, committer, message, tree, parents):
         None, author._sig, committer._sig, message, tree, parents).hex
 
 
+def rewrite_tag(repo, sha1, target):
+    """Copy the annotated tag object ``sha1``, but let it point to
+    ``target``. Signatures are dropped since they would be invalid."""
+    header, sep, message = repo[sha1].read_raw().partition(b'\n\n')
+    lines = header.split(b'\n')
+    lines[0] = b'object ' + target.encode('ascii')
+    message = strip_signature(message)
+    return repo.write(pygit2.GIT_OBJ_TAG, b'\n'.join(lines) + sep + message).hex
+
+
+def strip_signature(message):
+    """Cut a tag message at the first line that starts a signature."""
+    offset = 0
+    for line in message.splitlines(True):
+        if line.startswith(SIGNATURE_MARKERS):
+            return message[:offset]
+        offset += len(line)
+    return message
+
+
+def resolve_refs(repo, specs):
+    """Return the full names of the refs selected by the ``git rev-list``
+    arguments ``specs`` (e.g. ``--branches``, ``--tags=v1.*``, ``master``).
+    Symbolic refs are resolved. Negative revisions (``^A``, ``A..B``, or
+    anything after ``--not``) and refs excluded by ``--exclude`` are not
+    part of the result."""
+    names = [name for name in repo.listall_references()
+             if repo.lookup_reference(name).type == pygit2.GIT_REF_OID]
+    positive, negative = [], set()
+    def add(refs, negated):
+        if negated:
+            negative.update(refs)
+        else:
+            positive.extend(refs)
+    negate = False
+    excludes = []
+    for spec in specs:
+        option, _, pattern = spec.partition('=')
+        if spec == '--not':
+            negate = not negate
+        elif option == '--exclude':
+            excludes.append(pattern)
+        elif option == '--all' or option in REF_NAMESPACES:
+            prefix = REF_NAMESPACES.get(option, 'refs/')
+            if option == '--all' or not pattern:
+                pattern = '*'
+            elif not any(c in pattern for c in '*?['):
+                pattern += '/*'
+            if pattern.startswith(prefix):
+                prefix = ''
+            add([n for n in names
+                 if fnmatchcase(n, prefix + pattern)
+                 and not is_excluded(n, option, excludes)], negate)
+            # --exclude only applies to the next ref selection option:
+            excludes = []
+        elif not spec.startswith('-'):
+            if '...' in spec:
+                revs = [(rev, False) for rev in spec.split('...', 1)]
+            elif '..' in spec:
+                base, tip = spec.split('..', 1)
+                revs = [(base, True), (tip, False)]
+            elif spec.startswith('^'):
+                revs = [(spec[1:], True)]
+            else:
+                revs = [(spec, False)]
+            for rev, negated in revs:
+                add(filter(None, [lookup_ref(repo, rev)]), negated != negate)
+    return [name for name in dict.fromkeys(positive) if name not in negative]
+
+
+def is_excluded(name, option, excludes):
+    """Check if a ref selected by ``option`` matches an ``--exclude``."""
+    prefix = REF_NAMESPACES.get(option, '')
+    short = name[len(prefix):] if option != '--glob' else name
+    return any(fnmatchcase(name, ex) or fnmatchcase(short, ex)
+               for ex in excludes)
+
+
+def lookup_ref(repo, short):
+    """Return the full name of the direct ref for ``short`` (or None)."""
+    for prefix in REF_PREFIXES:
+        try:
+            return repo.lookup_reference(prefix + (short or 'HEAD')).resolve().name
+        except (KeyError, ValueError):
+            pass
+    return None
+
+
+def update_refs(updates, message):
+    """Apply all ``(ref, new, old)`` updates in a single transaction."""
+    args = ['git', 'update-ref', '-m', message, '--stdin']
+    text = ''.join('update {} {} {}\n'.format(*u) for u in updates)
+    proc = Popen(args, stdin=PIPE)
+    proc.communicate(text.encode('utf-8'))
+    if proc.returncode:
+        raise CalledProcessError(proc.returncode, args)
+
+
+# maximum nesting of coroutines started by `eager` before falling back to
+# tasks, e.g. when walking down a long chain of parent commits:
+EAGER_DEPTH = 64
+_eager_depth = 0
+
+
+def eager(aw):
+    """Start a coroutine immediately and return a future for its result.
+
+    The coroutine is run synchronously until it first suspends, and is only
+    wrapped in a task if it does. Cache hits and filters that return without
+    waiting on I/O therefore don't cost a round-trip through the event loop."""
+    global _eager_depth
+    if not asyncio.iscoroutine(aw) or _eager_depth >= EAGER_DEPTH:
+        return asyncio.ensure_future(aw)
+    future = asyncio.get_event_loop().create_future()
+    _eager_depth += 1
+    try:
+        yielded = aw.send(None)
+    except StopIteration as e:
+        future.set_result(e.value)
+        return future
+    except Exception as e:
+        future.set_exception(e)
+        return future
+    finally:
+        _eager_depth -= 1
+    return asyncio.ensure_future(_resume(aw, yielded))
+
+
+async def _resume(coro, yielded):
+    return await _Resumed(coro, yielded)
+
+
+class _Resumed:
+
+    """Awaitable that continues a coroutine that was started by `eager`."""
+
+    def __init__(self, coro, yielded):
+        self.coro = coro
+        self.yielded = yielded
+
+    def __await__(self):
+        coro, yielded = self.coro, self.yielded
+        while True:
+            try:
+                value = yield yielded
+            except GeneratorExit:
+                coro.close()
+                raise
+            except BaseException as e:
+                send, arg = coro.throw, e
+            else:
+                send, arg = coro.send, value
+            try:
+                yielded = send(arg)
+            except StopIteration as e:
+                return e.value
+
+
+def count_done(stats, name, future):
+    if future.done():
+        stats[name, 'done'] += 1
+    else:
+        future.add_done_callback(
+            lambda f: stats.update([(name, 'done')]))
+
+
 def cached(func):
-    cache = dict()
     def wrapper(self, *args):
+        cache = self._caches[func]
         key = self._hash(*args)
+        stats = self.cache_stats
+        if key not in cache:
+            stats[func.__name__, 'misses'] += 1
+            future = cache[key] = eager(func(self, *args))
+            count_done(stats, func.__name__, future)
+        elif not cache[key].done():
+            stats[func.__name__, 'pending'] += 1
+        else:
+            stats[func.__name__, 'hits'] += 1
+        return cache[key]
+    wrapper.__name__ = func.__name__
+    return wrapper
+
+
+def content_cached(func):
+    """Cache a blob transform ``func(self, sha1, *params) -> sha1`` keyed
+    only by the blob and the transform parameters (not by name or path). This
+    makes sure every blob is transformed at most once, even if it occurs at
+    many different locations. Results are recorded in ``self.content_store``
+    and may therefore be reused across runs."""
+    async def lookup(self, key, sha1, params):
+        result = self.content_store.get(key)
+        if result is None or result not in self.repo:
+            result = await func(self, sha1, *params)
+            self.content_store.put(key, result)
+        return result
+    def wrapper(self, sha1, *params):
+        key = (func.__name__, sha1) + params
+        cache = self._caches[func]
         if key not in cache:
-            cache[key] = asyncio.ensure_future(func(self, *args))
+            cache[key] = eager(lookup(self, key, sha1, params))
         return cache[key]
     wrapper.__name__ = func.__name__
     return wrapper
 
 
-def time_to_str(seconds):
-    return time.strftime('%H:%M:%S', time.gmtime(math.ceil(seconds)))
+class ContentStore:
+
+    """Results of :func:`content_cached` transforms, optionally persisted
+    to a file with one JSON list ``[*key, result]`` per line."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.data = {}
+        self._file = None
+        if path and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        *key, result = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.data[tuple(key)] = result
+
+    def __enter__(self):
+        if self.path:
+            self._file = open(self.path, 'at')
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def put(self, key, result):
+        self.data[key] = result
+        if self._file is not None:
+            self._file.write(json.dumps([*key, result]) + '\n')
+
+
+def parse_options(args):
+    """Split ``--name=value`` options from positional arguments."""
+    opts = {}
+    rest = []
+    for arg in args:
+        if arg.startswith('--') and '=' in arg:
+            name, value = arg[2:].split('=', 1)
+            opts[name.replace('-', '_')] = value
+        else:
+            rest.append(arg)
+    return rest, opts
+
+
+def read_objmap(path):
+    """Read a file with lines ``OLD NEW`` into a dict. Other lines (e.g. an
+    incomplete last line of an interrupted run) are ignored."""
+    objmap = {}
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 2:
+                objmap[fields[0]] = fields[1]
+    return objmap
 
 
 def SECTION(title):
@@ -200,30 +595,92 @@ def SECTION(title):
 
 class TreeFilter(object):
 
+    # options that can be passed as --name=value before the `--`, with the
+    # function to convert their value (see README):
+    options = {
+        'content_cache': str,
+        'order': str,
+        'window': int,
+        'prefetch': int,
+        'boundary_map': str,
+        'progress': renderer_name,
+        'progress_interval': float,
+        'progress_file': str,
+    }
+
+    # defaults for the options:
+    content_cache = None        # file to persist content transforms in
+    order = 'topo'              # order in which roots are scheduled
+    window = 64                 # lookahead for the 'path' order
+    prefetch = 16               # number of roots to read ahead (0: disable)
+    boundary_map = None         # file with `OLD NEW` commits for boundaries
+    progress = 'auto'           # progress renderer: auto, tty, json, none
+    progress_interval = None    # seconds between progress updates
+    progress_file = None        # file for progress output (default: stdio)
+
+    # number of trees kept in memory by the prefetcher, and number of trees
+    # read by a single executor job:
+    object_cache_size = 10000
+    prefetch_batch = 256
+
+    # maximum number of entries of a single tree rewritten concurrently:
+    chunk_size = 1024
+
+    # executor for git operations (None: the loop's default executor):
+    executor = None
+
     def __init__(self):
         self.gitdir = pygit2.discover_repository('.')
         self.objmap = os.path.join(self.gitdir, 'objmap')
+        self.index_path = os.path.join(self.gitdir, 'tree-index')
         self.repo = Repository(self.gitdir)
+        self.tree_index = None
+        self.cache_stats = Counter()
+        # results of @cached and @content_cached methods, per function:
+        self._caches = defaultdict(dict)
+        self.object_cache = None
+        self.progress_stream = None
+        self.prefetched = set()
+        # commits to be rewritten (None: all reachable), other commits are
+        # boundaries that map to `self.boundary.get(sha1, sha1)`:
+        self.commits = None
+        self.boundary = {}
 
     def rewrite_root(self, sha1):
         sha1 = sha1.strip()
         obj = self.repo[sha1]
         if obj.type == pygit2.GIT_OBJ_TREE:
             return self.rewrite_root_tree(sha1)
-        # TODO: what about tags?
+        if obj.type == pygit2.GIT_OBJ_TAG:
+            return self.rewrite_root_tag(sha1)
         return self.rewrite_root_commit(sha1)
 
+    @cached
+    async def rewrite_root_tag(self, sha1):
+        target = self.repo[sha1].target.hex
+        if self.repo[target].type == pygit2.GIT_OBJ_BLOB:
+            return sha1
+        new_target = await self.rewrite_root(target)
+        if new_target == target:
+            return sha1
+        return await self.run_in_executor(
+            rewrite_tag, self.repo, sha1, new_target)
+
     @cached
     async def rewrite_root_commit(self, sha1):
+        if self.commits is not None and sha1 not in self.commits:
+            return self.boundary.get(sha1, sha1)
         commit = self.repo[sha1]
         ids = [commit.tree_id] + commit.parent_ids
         tree, *parents = await asyncio.gather(*[
             asyncio.ensure_future(self.rewrite_root(id.hex))
             for id in ids
         ])
-        return await self.create_commit(
+        new = await self.create_commit(
             Signature(commit.author), Signature(commit.committer),
             commit.message, tree, parents)
+        self.objmap_file.write('{} {}\n'.format(sha1, new))
+        return new
 
     @cached
     async def rewrite_root_tree(self, sha1):
@@ -235,21 +692,68 @@ class TreeFilter(object):
     @cached
     async def rewrite_tree(self, obj):
         """Rewrite all folder items individually, recursive."""
+        if not self.should_descend(obj.path):
+            return [obj[:]]
+        if self.tree_index is not None and self.tree_index.skip(obj.sha1):
+            return [obj[:]]
         old_entries = list(await self.read_tree(obj.sha1))
-        new_entries = list(await self.map_tree(obj, old_entries))
-        if new_entries != old_entries:
-            sha1 = await self.write_tree(new_entries)
+        results = await self.map_entries(obj, old_entries)
+        if self.tree_index is not None:
+            self.tree_index.add_tree(obj.sha1, old_entries)
+        changed = [i for i, (entry, result) in enumerate(zip(old_entries, results))
+                   if result != [entry]]
+        if not changed:
+            return [obj[:]]
+        # Only send the changed entries to the executor, unless they collide
+        # with the names of unchanged entries (where order matters):
+        removed = [old_entries[i][3] for i in changed]
+        added = [entry for i in changed for entry in results[i]]
+        kept = {entry[3] for entry in old_entries}.difference(removed)
+        if kept.isdisjoint(entry[3] for entry in added):
+            sha1 = await self.update_tree(obj.sha1, removed, added)
         else:
-            sha1 = obj.sha1
+            sha1 = await self.write_tree(
+                [entry for result in results for entry in result])
         return [(obj.mode, obj.kind, sha1, obj.name)]
 
     async def map_tree(self, obj, entries):
-        results = await asyncio.gather(*[
-            self.rewrite_object(obj.child(*entry))
-            for entry in entries
-        ])
+        results = await self.map_entries(obj, entries)
         return [entry for entries in results for entry in entries]
 
+    async def map_entries(self, obj, entries):
+        """Rewrite the entries of a tree and return the list of results (one
+        list of new entries per old entry). Entries are dispatched in chunks
+        of ``chunk_size`` to bound the number of pending futures, and entries
+        that are known to be unaffected are not dispatched at all."""
+        results = [[entry] for entry in entries]
+        todo = [i for i, entry in enumerate(entries)
+                if not self.unaffected(entry)]
+        size = self.chunk_size
+        for start in range(0, len(todo), size):
+            chunk = todo[start:start+size]
+            futures = [self.rewrite_object(obj.child(*entries[i]))
+                       for i in chunk]
+            # cache hits and synchronous rewrites are already resolved:
+            pending = [future for future in futures if not future.done()]
+            if pending:
+                await asyncio.gather(*pending)
+            for i, future in zip(chunk, futures):
+                results[i] = future.result()
+        return results
+
+    def unaffected(self, entry):
+        """Check if the tree index proves that the entry stays unchanged."""
+        index = self.tree_index
+        if index is None:
+            return False
+        mode, kind, sha1, name = entry
+        # the name of a tree is not part of its own summary:
+        if kind == 'tree':
+            return index.skip_name(name) and index.skip(sha1)
+        if kind == 'blob':
+            return index.skip_name(name)
+        return False
+
     @cached
     def rewrite_object(self, obj):
         rewrite = getattr(self, DISPATCH.get(obj.kind, 'rewrite_fallback'))
@@ -265,6 +769,24 @@ class TreeFilter(object):
         # In general, we have to depend on all metadata + location
         return (obj[:], obj.path, obj.mode)
 
+    def should_descend(self, path):
+        """Check if the subtree at ``path`` may have to be changed. Subtrees
+        for which this is false are neither read nor prefetched."""
+        return True
+
+    def index_keys(self):
+        """Return the keys (see ``tree_index``) of all entries that the filter
+        may change, or None if it may act on any entry. Subtrees that contain
+        none of these keys are left untouched without being read."""
+        return None
+
+    def open_tree_index(self):
+        """Return the :class:`TreeIndex` to be used during the rewrite."""
+        keys = self.index_keys()
+        if keys is not None:
+            return TreeIndex(self.index_path, keys)
+        return None
+
     def _hash(self, obj=None):
         return hash(self.depends(obj) if isinstance(obj, DirEntry) else obj)
 
@@ -276,8 +798,7 @@ class TreeFilter(object):
         if '--' in args:
             cut = args.index('--')
             args, refs = args[:cut], args[cut+1:]
-            objs = communicate(['git', 'rev-list', *refs])
-            objs = sorted(set(objs.splitlines()))
+            objs = None
         else:
             objs = list(sys.stdin)
             refs = []
@@ -285,28 +806,120 @@ class TreeFilter(object):
         size = 2*multiprocessing.cpu_count()
         pool = ProcessPoolExecutor(size)
         loop = asyncio.get_event_loop()
-        loop.set_default_executor(pool)
 
+        args, opts = parse_options(args)
         instance = cls(*args)
         instance.size = size
+        # NOTE: python≥3.9 refuses a ProcessPoolExecutor as default executor:
+        instance.executor = pool
+        instance.set_options(**opts)
+        if objs is None:
+            objs = instance.list_roots(refs)
+            instance.commits = set(objs)
         future = asyncio.ensure_future(instance.filter(objs, refs))
-        loop.run_until_complete(future)
+        try:
+            loop.run_until_complete(future)
+        finally:
+            pool.shutdown()
         return future.result()
 
+    def set_options(self, **opts):
+        """Set options from the ``--name=value`` arguments listed in
+        ``options``. Raise ValueError on unknown options or invalid values."""
+        for name, value in opts.items():
+            option = '--' + name.replace('_', '-')
+            convert = self.options.get(name)
+            if convert is None:
+                raise ValueError("Unknown option: {}".format(option))
+            try:
+                value = convert(value)
+            except ValueError:
+                raise ValueError("Invalid value for {}: {!r}".format(
+                    option, value))
+            setattr(self, name, value)
+
+    def list_roots(self, refs):
+        """List the commits selected by ``refs`` in the order that they
+        should be scheduled in, as given by the method ``order_<NAME>``."""
+        order = getattr(self, 'order_' + self.order, None)
+        if order is None:
+            raise ValueError("Unknown order: {}".format(self.order))
+        return order(refs)
+
+    def order_sha(self, refs):
+        """Sorted by SHA1, i.e. random with respect to history."""
+        return sorted(set(communicate(['git', 'rev-list', *refs]).splitlines()))
+
+    def order_topo(self, refs):
+        """Parents before children."""
+        return communicate([
+            'git', 'rev-list', '--topo-order', '--reverse', *refs]).splitlines()
+
+    def order_date(self, refs):
+        """By commit date, but parents before children."""
+        return communicate([
+            'git', 'rev-list', '--date-order', '--reverse', *refs]).splitlines()
+
+    def order_path(self, refs):
+        """Topological, but prefer roots that share top-level subtrees with
+        recently started ones (see :meth:`scorer`)."""
+        return self.order_topo(refs)
+
+    def scorer(self):
+        """Return the scorer for the :class:`PriorityQueue`, or None."""
+        if self.order == 'path':
+            return Locality(self.repo)
+        return None
+
     async def filter(self, objs, refs):
         if os.path.exists(self.objmap):
             print("objmap already exists:", self.objmap)
             print("If there is no other rebase in progress, please clean up\n"
                   "this folder and retry.")
             return 1
-        with open(self.objmap, 'wt') as f:
-            self.objmap_file = f
+        if self.boundary_map:
+            self.boundary = read_objmap(self.boundary_map)
+        with ExitStack() as stack:
+            # the objmap is created last, so that it is not left behind if
+            # one of the other files can't be opened:
+            self.open_progress_file(stack)
+            self.content_store = stack.enter_context(
+                ContentStore(self.content_cache))
+            self.tree_index = self.open_tree_index()
+            if self.tree_index is not None:
+                stack.enter_context(self.tree_index)
+            self.objmap_file = stack.enter_context(open(self.objmap, 'wt'))
             return (await self.filter_tree(objs) or
                     await self.filter_branch(refs))
 
     async def filter_tree(self, objs):
         SECTION("Rewriting trees")
-        await process_objects(self.size, self.rewrite_root, objs)
+        self.object_cache = ObjectCache(self.object_cache_size)
+        await process_objects(self.size, self.rewrite_root, objs,
+                              self.scorer(), self.window,
+                              self.prefetch_roots if self.prefetch else None,
+                              self.make_progress('trees'))
+        self.print_cache_stats()
+
+    def open_progress_file(self, stack):
+        """Open the ``--progress-file`` (if any) for the ``ExitStack``."""
+        if self.progress_file:
+            self.progress_stream = stack.enter_context(
+                open(self.progress_file, 'wt'))
+
+    def make_progress(self, phase):
+        renderer = make_renderer(self.progress, self.progress_stream)
+        return Progress(renderer, self.cache_stats, phase,
+                        interval=self.progress_interval)
+
+    def print_cache_stats(self):
+        stats = self.cache_stats
+        for name in sorted({name for name, _ in stats}):
+            hits, pending, misses = (
+                stats[name, 'hits'], stats[name, 'pending'], stats[name, 'misses'])
+            total = hits + pending + misses
+            print("{}: {} calls, {:.1f}% hits, {:.1f}% waiting on pending"
+                  .format(name, total, 100 * hits / total, 100 * pending / total))
 
     async def filter_branch(self, refs):
         if not refs:
@@ -321,29 +934,84 @@ class TreeFilter(object):
         SECTION("Rewriting commits")
         revs = communicate(['git', 'rev-list', '--reverse', *refs])
         revs = revs.splitlines()
-        await process_objects(self.size, self.rewrite_root, revs)
+        await process_objects(self.size, self.rewrite_root, revs,
+                              progress=self.make_progress('commits'))
 
         SECTION("Updating refs")
-        for short in refs:
-            refs = communicate(['git', 'rev-parse', '--symbolic-full-name', short])
-            for ref in refs.splitlines():
-                old = self.repo.revparse_single(ref)
-                new = await self.rewrite_root(old.hex)
-                if old.hex == new:
-                    print("WARNING: Ref {!r} is unchanged".format(ref))
-                else:
-                    self.repo.references[ref].set_target(new, "tree-filter")
-                    print("Ref {!r} was rewritten".format(ref))
+        names = resolve_refs(self.repo, refs)
+        olds = [self.repo.lookup_reference(name).target.hex for name in names]
+        # annotated tags are rewritten in parallel:
+        news = await asyncio.gather(*[self.rewrite_root(old) for old in olds])
+        updates = []
+        for ref, old, new in zip(names, olds, news):
+            if old == new:
+                print("WARNING: Ref {!r} is unchanged".format(ref))
+            else:
+                updates.append((ref, new, old))
+                print("Ref {!r} was rewritten".format(ref))
+        update_refs(updates, "tree-filter")
         return 0
 
+    async def prefetch_roots(self, queue, objs):
+        """Read the trees of the next few roots ahead of the ``queue`` into
+        ``self.object_cache``, so that ``read_tree`` rarely has to wait.
+
+        Trees are read breadth first, one level of all new trees at a time,
+        in batches of ``prefetch_batch`` per executor job. Subtrees that the
+        filter doesn't descend into (see :meth:`should_descend`) are skipped."""
+        ahead = self.prefetch
+        for i, sha1 in enumerate(objs):
+            while i >= queue.num_total - queue.num_pending + ahead:
+                queue.progress.clear()
+                await queue.progress.wait()
+            obj = self.repo[sha1.strip()]
+            if obj.type == pygit2.GIT_OBJ_COMMIT:
+                level = {obj.tree_id.hex: ''}
+            elif obj.type == pygit2.GIT_OBJ_TREE:
+                level = {obj.hex: ''}
+            else:
+                continue
+            # map tree_id -> path (the first path it was found under):
+            while level:
+                level = {tree_id: path for tree_id, path in level.items()
+                         if tree_id not in self.prefetched
+                         and self.should_descend(path) and not (
+                             self.tree_index and self.tree_index.skip(tree_id))}
+                self.prefetched.update(level)
+                ids = list(level)
+                size = self.prefetch_batch
+                results = await asyncio.gather(*[
+                    self.run_in_executor(read_trees, self.repo, ids[k:k+size])
+                    for k in range(0, len(ids), size)
+                ])
+                entries = [tree for result in results for tree in result]
+                children = {}
+                for tree_id, tree in zip(ids, entries):
+                    self.object_cache.put(tree_id, tree)
+                    prefix = level[tree_id] and level[tree_id] + '/'
+                    for mode, kind, sha1, name in tree:
+                        if kind == 'tree':
+                            children.setdefault(sha1, prefix + name)
+                level = children
+
     def read_tree(self, sha1):
         """Iterate over tuples (mode, kind, sha1, name)."""
+        cache = self.object_cache
+        entries = cache.get(sha1) if cache is not None else None
+        if entries is not None:
+            future = asyncio.get_event_loop().create_future()
+            future.set_result(entries)
+            return future
         return self.run_in_executor(read_tree, self.repo, sha1)
 
     def write_tree(self, entries):
         """Create a tree and return the hash."""
         return self.run_in_executor(write_tree, self.repo, entries)
 
+    def update_tree(self, base, removed, added):
+        """Create a modified copy of a tree and return the hash."""
+        return self.run_in_executor(update_tree, self.repo, base, removed, added)
+
     def read_blob(self, sha1):
         return self.run_in_executor(read_blob, self.repo, sha1)
 
@@ -355,4 +1023,4 @@ class TreeFilter(object):
 
     def run_in_executor(self, fn, *args):
         loop = asyncio.get_event_loop()
-        return loop.run_in_executor(None, fn, *args)
+        return loop.run_in_executor(self.executor, fn, *args)
@@ -0,0 +1,181 @@
+"""
+Persistent index of per-tree name summaries.
+
+For every tree, a summary of the names and filename extensions of all entries
+below it is stored (keyed by the tree SHA1). Filters that only act on entries
+with specific names or extensions can use it to skip subtrees without reading
+them. The index only depends on the tree objects themselves, so it stays
+valid across runs and can be shared between different filters.
+
+Trees with few distinct keys store the exact set of key hashes, larger trees
+a bloom filter. Bloom filters that are too full to ever allow skipping a tree
+are stored as ``full``. The summary of a tree is the union of those of its
+entries, so each representation is only used where it pays off: small trees
+stay compact, and large trees remain skippable.
+"""
+
+import hashlib
+from array import array
+from functools import lru_cache
+
+
+SMALL = 256             # max number of keys stored as exact set
+BITS = 1 << 14          # size of the bloom filter for larger trees
+HASHES = 3
+MAX_FILL = 0.5          # bloom filters with more bits set are 'full'
+HEADER = '# tree-index v2 small={} bits={} hashes={}\n'.format(
+    SMALL, BITS, HASHES)
+
+FULL = 'full'           # summary of a tree that may contain any key
+
+
+def name_key(name):
+    return 'name:' + name
+
+
+def ext_key(ext):
+    return 'ext:' + ext
+
+
+def entry_keys(name):
+    """Yield all keys under which an entry with this name is indexed."""
+    yield name_key(name)
+    i = name.find('.')
+    while i != -1:
+        yield ext_key(name[i:])
+        i = name.find('.', i + 1)
+
+
+@lru_cache(maxsize=65536)
+def key_hash(key):
+    """Return the 64 bit hash of a key."""
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+@lru_cache(maxsize=65536)
+def hash_bits(h):
+    """Return the bloom filter bits for a key hash."""
+    h1, h2 = h & 0xffffffff, (h >> 32) | 1
+    bits = 0
+    for i in range(HASHES):
+        bits |= 1 << ((h1 + i * h2) % BITS)
+    return bits
+
+
+def format_summary(summary):
+    if summary is FULL:
+        return FULL
+    if isinstance(summary, int):
+        return 'b{:x}'.format(summary)
+    return 'k' + ''.join('{:016x}'.format(h) for h in summary)
+
+
+def parse_summary(text):
+    if text == FULL:
+        return FULL
+    if text.startswith('b'):
+        return int(text[1:], 16)
+    if text.startswith('k'):
+        return array('Q', (int(text[i:i+16], 16)
+                           for i in range(1, len(text), 16)))
+    raise ValueError("Invalid summary: {!r}".format(text))
+
+
+class TreeIndex:
+
+    """
+    Map tree SHA1 -> summary, backed by an append-only file. A summary is
+    an array of key hashes, a bloom filter (int) or ``FULL``.
+
+    If ``keys`` is given, :meth:`skip` tells whether a tree is known not to
+    contain any entry matching one of the keys.
+    """
+
+    def __init__(self, path, keys=None):
+        self.path = path
+        self.keys = None if keys is None else frozenset(keys)
+        self.query = None if keys is None else [
+            (key_hash(k), hash_bits(key_hash(k))) for k in keys]
+        self.summaries = {}
+        self._file = None
+        self._valid = False
+        self._partial = False
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                if f.readline() != HEADER:
+                    return
+                self._valid = True
+                for line in f:
+                    self._partial = not line.endswith('\n')
+                    try:
+                        sha1, text = line.split()
+                        self.summaries[sha1] = parse_summary(text)
+                    except ValueError:
+                        pass
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        if self._valid:
+            self._file = open(self.path, 'at')
+            if self._partial:
+                self._file.write('\n')
+        else:
+            self._file = open(self.path, 'wt')
+            self._file.write(HEADER)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._file.close()
+        self._file = None
+
+    def skip(self, sha1):
+        """Check if the tree is known to contain none of the keys."""
+        if self.query is None:
+            return False
+        summary = self.summaries.get(sha1)
+        if summary is None or summary is FULL:
+            return False
+        if isinstance(summary, int):
+            return not any(summary & bits == bits for h, bits in self.query)
+        return not any(h in summary for h, bits in self.query)
+
+    def skip_name(self, name):
+        """Check if an entry name matches none of the keys."""
+        return self.keys is not None and self.keys.isdisjoint(entry_keys(name))
+
+    def add_tree(self, sha1, entries):
+        """Store the summary of a tree from its ``(mode, kind, sha1, name)``
+        entries. Does nothing if the summary of a subtree is unknown."""
+        if sha1 in self.summaries:
+            return
+        hashes = set()
+        bloom = 0
+        large = full = False
+        for mode, kind, child, name in entries:
+            hashes.update(key_hash(key) for key in entry_keys(name))
+            if kind == 'tree':
+                sub = self.summaries.get(child)
+                if sub is None:
+                    return
+                if sub is FULL:
+                    full = True
+                elif isinstance(sub, int):
+                    bloom |= sub
+                    large = True
+                else:
+                    hashes.update(sub)
+        if not large and not full and len(hashes) <= SMALL:
+            summary = array('Q', sorted(hashes))
+        else:
+            for h in hashes:
+                bloom |= hash_bits(h)
+            full = full or bin(bloom).count('1') > MAX_FILL * BITS
+            summary = FULL if full else bloom
+        self.summaries[sha1] = summary
+        if self._file is not None:
+            self._file.write('{} {}\n'.format(sha1, format_summary(summary)))
@@ -13,7 +13,8 @@ Arguments:
 See also: http://coldfix.de/2017/06/11/git-unpack
 """
 
-from .tree_filter import TreeFilter, cached
+from .tree_filter import TreeFilter, cached, content_cached
+from .tree_index import name_key, ext_key
 
 import os
 
@@ -34,6 +35,11 @@ class Unpack(TreeFilter):
     def depends(self, obj):
         return (obj.sha1, obj.name, obj.mode)
 
+    def index_keys(self):
+        if self.ext.startswith('.'):
+            return [ext_key(self.ext), name_key('.gitattributes')]
+        return None
+
     @cached
     async def rewrite_file(self, obj):
         mode, kind, sha1, name = obj
@@ -45,9 +51,13 @@ class Unpack(TreeFilter):
             ).encode('utf-8'))
         elif name.endswith(self.ext):
             name, ext = os.path.splitext(name)
-            sha1 = await self.run_in_executor(extract, sha1, self.program)
+            sha1 = await self.unpack_blob(sha1, self.program)
         return [(mode, kind, sha1, name)]
 
+    @content_cached
+    async def unpack_blob(self, sha1, program):
+        return await self.run_in_executor(extract, sha1, program)
+
 
 def fix_gitattr_line(line, ext):
     name, attr = line.split(' ', 1)
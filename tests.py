@@ -1,14 +1,37 @@
 
+import asyncio
 import tempfile
 import subprocess
 import unittest
+import unittest.mock
 import shutil
 import os
-from io import BytesIO
+from contextlib import contextmanager
+from io import BytesIO, StringIO
+from collections import Counter
+from types import SimpleNamespace
+import json
+import hashlib
 from gzip import GzipFile
 
 import pygit2 as git
 
+from git_filter_tree.tree_index import TreeIndex, name_key, ext_key
+from git_filter_tree.tree_filter import (
+    Locality, ObjectCache, PriorityQueue, TreeFilter, eager, parse_options,
+    process_objects,
+    read_objmap, resolve_refs, rewrite_tag, update_refs)
+from git_filter_tree.dir2mod import Dir2Mod
+from git_filter_tree.index import Index
+from git_filter_tree.dos2unix import Dos2Unix
+from git_filter_tree.unpack import Unpack
+from git_filter_tree.bigfiles import BigFiles, STUB, large_blobs, parse_size
+from git_filter_tree.lfs import LFS, POINTER, store_lfs_object
+from git_filter_tree.rm import Rm
+from git_filter_tree.path_matcher import PathMatcher
+from git_filter_tree.progress import (
+    Progress, JSONRenderer, TTYRenderer, make_renderer)
+
 
 def gzip(name, data):
     sio = BytesIO()
@@ -96,6 +119,34 @@ def init_test_repo(path, bare=True):
     return repo
 
 
+@contextmanager
+def chdir(path):
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+
+def run_filter(cls, path, args, refs=('--branches', '--tags')):
+    """Run a filter in-process on the repository at ``path``."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        with chdir(path):
+            return cls.main(['--progress=none', *args, '--', *refs])
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+
+
+def ls_files(path, rev):
+    return subprocess.check_output([
+        'git', '-C', path, 'ls-tree', '-r', '-z', '--name-only', rev,
+    ]).decode('utf-8').split('\0')[:-1]
+
+
 class TestTreeFilter(unittest.TestCase):
 
     maxDiff = None
@@ -163,5 +214,830 @@ class TestTreeFilter(unittest.TestCase):
         shutil.rmtree(path_fast)
 
 
+class TestRefs(unittest.TestCase):
+
+    tagger = git.Signature('Lord Buckethead', 'lord@bucket.head', 0, 0)
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.repo = init_test_repo(self.path)
+        self.head = self.repo.head.target
+        self.first = self.repo[self.head].parents[0].id
+        self.repo.create_branch('wip', self.repo[self.first])
+        self.repo.create_branch('feature', self.repo[self.head])
+        self.repo.create_tag('v1.0', self.first, git.GIT_OBJ_COMMIT,
+                             self.tagger, 'Version 1.0\n')
+        self.repo.create_tag('v2.0', self.head, git.GIT_OBJ_COMMIT,
+                             self.tagger, 'Version 2.0\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_resolve_refs(self):
+        resolve = lambda *specs: sorted(resolve_refs(self.repo, specs))
+        heads = ['refs/heads/feature', 'refs/heads/master', 'refs/heads/wip']
+        tags = ['refs/tags/v1.0', 'refs/tags/v2.0']
+        self.assertEqual(resolve('--branches'), heads)
+        self.assertEqual(resolve('--all'), heads + tags)
+        self.assertEqual(resolve('--tags=v1*'), tags[:1])
+        self.assertEqual(resolve('master', 'v2.0'), heads[1:2] + tags[1:])
+        self.assertEqual(resolve('HEAD'), heads[1:2])
+        self.assertEqual(resolve('v1.0..wip'), heads[2:])
+        self.assertEqual(resolve('--branches', '^wip'), heads[:2])
+        self.assertEqual(resolve('master', '--not', 'v1.0'), heads[1:2])
+        self.assertEqual(resolve('--not', 'wip', '--not', 'feature'), heads[:1])
+        self.assertEqual(resolve('--exclude=wip', '--branches'), heads[:2])
+        self.assertEqual(resolve('--exclude=refs/heads/wip', '--branches'),
+                         heads[:2])
+        # --exclude only applies to the next option:
+        self.assertEqual(resolve('--exclude=wip', '--tags', '--branches'),
+                         heads + tags)
+        self.assertEqual(resolve('--unknown-option', 'nonexistent'), [])
+
+    def test_rewrite_tag(self):
+        tag = self.repo.lookup_reference('refs/tags/v1.0').target
+        new = rewrite_tag(self.repo, tag.hex, self.head.hex)
+        self.assertEqual(self.repo[new].target, self.head)
+        self.assertEqual(self.repo[new].name, 'v1.0')
+        self.assertEqual(self.repo[new].message, 'Version 1.0\n')
+
+    def test_rewrite_signed_tag(self):
+        for kind in ['PGP SIGNATURE', 'SSH SIGNATURE', 'SIGNED MESSAGE']:
+            data = (
+                'object {}\ntype commit\ntag signed\n'
+                'tagger Lord Buckethead <lord@bucket.head> 0 +0000\n\n'
+                'Signed\n-----BEGIN {kind}-----\n\nxyz\n'
+                '-----END {kind}-----\n'
+            ).format(self.first.hex, kind=kind).encode('utf-8')
+            tag = self.repo.write(git.GIT_OBJ_TAG, data)
+            new = rewrite_tag(self.repo, tag.hex, self.head.hex)
+            self.assertEqual(self.repo[new].target, self.head)
+            self.assertEqual(self.repo[new].message, 'Signed\n')
+
+    def test_update_refs(self):
+        master = 'refs/heads/master'
+        wip = 'refs/heads/wip'
+        with chdir(self.path):
+            update_refs([(master, self.first.hex, self.head.hex),
+                         (wip, self.head.hex, self.first.hex)], 'test')
+        self.assertEqual(self.repo.lookup_reference(master).target, self.first)
+        self.assertEqual(self.repo.lookup_reference(wip).target, self.head)
+        # all or nothing if one of the old values doesn't match:
+        with chdir(self.path), self.assertRaises(subprocess.CalledProcessError):
+            update_refs([(master, self.head.hex, self.first.hex),
+                         (wip, self.first.hex, self.first.hex)], 'test')
+        self.assertEqual(self.repo.lookup_reference(master).target, self.first)
+
+    def test_filter_rewrites_tags(self):
+        v2 = self.repo.lookup_reference('refs/tags/v2.0').target
+        self.repo.create_tag('v2.0-alias', v2, git.GIT_OBJ_TAG,
+                             self.tagger, 'Tag of a tag\n')
+        run_filter(Rm, self.path, ['nested/subdir/small file'])
+        repo = git.Repository(self.path)
+        master = repo.lookup_reference('refs/heads/master').target
+        self.assertNotEqual(master, self.head)
+        self.assertEqual(ls_files(self.path, master.hex),
+                         ['nested/subdir/large file.gz', 'sibling/ûnïçoδΣ'])
+        tag = repo[repo.lookup_reference('refs/tags/v2.0').target]
+        self.assertEqual(tag.target, master)
+        alias = repo[repo.lookup_reference('refs/tags/v2.0-alias').target]
+        self.assertEqual(alias.target, tag.id)
+        self.assertEqual(alias.message, 'Tag of a tag\n')
+
+
+class TestOptions(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.repo = init_test_repo(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def make_filter(self, *args):
+        args, opts = parse_options(args)
+        with chdir(self.path):
+            instance = TreeFilter(*args)
+        instance.set_options(**opts)
+        return instance
+
+    def test_convert(self):
+        instance = self.make_filter(
+            '--order=path', '--window=8', '--prefetch=0',
+            '--progress=json', '--progress-interval=0.5',
+            '--content-cache=cache', '--boundary-map=objmap')
+        self.assertEqual(instance.order, 'path')
+        self.assertEqual(instance.window, 8)
+        self.assertEqual(instance.prefetch, 0)
+        self.assertEqual(instance.progress, 'json')
+        self.assertEqual(instance.progress_interval, 0.5)
+        self.assertEqual(instance.content_cache, 'cache')
+        self.assertEqual(instance.boundary_map, 'objmap')
+
+    def test_index(self):
+        run_filter(Index, self.path, [])
+        index = TreeIndex(os.path.join(self.path, 'tree-index'))
+        tree = self.repo[self.repo.head.target].tree
+        for sha1 in [tree.id, tree['nested'].id, tree['sibling'].id]:
+            self.assertIn(sha1.hex, index.summaries)
+
+    def test_setup_failure(self):
+        objmap = os.path.join(self.path, 'objmap')
+        missing = os.path.join(self.path, 'missing', 'file')
+        with self.assertRaises(ValueError):
+            run_filter(Rm, self.path, ['--progress=bogus', 'sibling'])
+        with self.assertRaises(FileNotFoundError):
+            run_filter(Rm, self.path, ['--progress-file=' + missing, 'sibling'])
+        with self.assertRaises(FileNotFoundError):
+            run_filter(Rm, self.path, ['--content-cache=' + missing, 'sibling'])
+        self.assertFalse(os.path.exists(objmap))
+
+    def test_reject(self):
+        for arg in ['--chunk-size=1', '--prefetch-batch=1',
+                    '--object-cache-size=1', '--filter-tree=x',
+                    '--repo=x', '--_hash=x', '--prefetch=many',
+                    '--progress=bogus']:
+            with self.assertRaises(ValueError):
+                self.make_filter(arg)
+
+
+class TestOrder(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.repo = init_test_repo(self.path)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        shutil.rmtree(self.path)
+
+    def test_parents_first(self):
+        first = self.repo[self.repo.head.target].parent_ids[0]
+        side = Branch(self.repo, first, name='refs/heads/side')
+        side.commit("Side", {'side': "side\n"})
+        master = Branch(self.repo, self.repo.head.target)
+        master.commit("Merge", {'merged': "merged\n"}, *side.head)
+        with chdir(self.path):
+            instance = TreeFilter()
+            for order in ['topo', 'date', 'path']:
+                instance.order = order
+                roots = instance.list_roots(['--branches'])
+                self.assertEqual(len(roots), 7)
+                for i, sha1 in enumerate(roots):
+                    for parent in self.repo[sha1].parent_ids:
+                        self.assertLess(roots.index(parent.hex), i)
+            instance.order = 'sha'
+            self.assertEqual(instance.list_roots(['--branches']),
+                             sorted(roots))
+
+    def make_roots(self):
+        # 'b' shares the subtree 'x' with 'a', 'c' shares nothing:
+        trees = {
+            'a': {'x': {'f': "1\n"}, 'y': {'f': "2\n"}},
+            'b': {'x': {'f': "1\n"}, 'y': {'f': "3\n"}},
+            'c': {'x': {'f': "4\n"}, 'y': {'f': "5\n"}},
+        }
+        roots = {}
+        for name, tree in trees.items():
+            branch = Branch(self.repo, name='refs/heads/' + name)
+            branch.commit(name, tree)
+            roots[name] = branch.head[0].hex
+        return roots
+
+    def test_locality(self):
+        roots = self.make_roots()
+        locality = Locality(self.repo)
+        self.assertEqual([locality.score(roots[n]) for n in 'abc'], [0, 0, 0])
+        locality.started(roots['a'])
+        self.assertEqual([locality.score(roots[n]) for n in 'bc'], [1, 0])
+        locality.started(roots['c'])
+        self.assertEqual(locality.score(roots['b']), 1)
+        # only the most recent objects are remembered:
+        locality = Locality(self.repo, memory=3)
+        locality.started(roots['a'])
+        locality.started(roots['c'])
+        self.assertEqual(locality.score(roots['b']), 0)
+
+    def test_priority_queue(self):
+        scores = dict(a=0, b=2, c=1, d=5)
+        started = []
+        scorer = SimpleNamespace(score=scores.get, started=started.append)
+        queue = PriorityQueue(1, None, str.upper, scorer, 2)
+        queue.jobs = iter('abcd')
+        self.assertEqual([queue._next() for _ in range(4)], list('BCDA'))
+        self.assertEqual(started, list('bcda'))
+        self.assertRaises(StopIteration, queue._next)
+
+    def test_path_order(self):
+        roots = self.make_roots()
+        order = []
+        async def rewrite(sha1):
+            order.append(sha1)
+        self.loop.run_until_complete(process_objects(
+            1, rewrite, [roots[n] for n in 'acb'], Locality(self.repo), 3,
+            progress=Progress(None, Counter(), '')))
+        self.assertEqual(order, [roots[n] for n in 'abc'])
+
+
+class TestRange(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.repo = init_test_repo(self.path)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        shutil.rmtree(self.path)
+
+    def test_read_objmap(self):
+        path = os.path.join(self.path, 'objmap')
+        with open(path, 'w') as f:
+            f.write('a b\n\nc d\nmalformed\ne f g\nh')
+        self.assertEqual(read_objmap(path), {'a': 'b', 'c': 'd'})
+
+    def test_empty(self):
+        self.loop.run_until_complete(asyncio.wait_for(process_objects(
+            4, None, [], progress=Progress(None, Counter(), '')), 1))
+
+    def rewrite_head(self, boundary):
+        with chdir(self.path):
+            instance = Rm('nonexistent')
+        instance.objmap_file = StringIO()
+        instance.commits = {self.repo.head.target.hex}
+        instance.boundary = boundary
+        head = self.repo.head.target.hex
+        return self.repo[self.loop.run_until_complete(
+            instance.rewrite_root_commit(head))]
+
+    def test_boundary(self):
+        head = self.repo[self.repo.head.target]
+        parent = self.repo[head.parent_ids[0]]
+        # boundary commits are kept by default:
+        commit = self.rewrite_head({})
+        self.assertEqual(commit.id, head.id)
+        # or replaced according to the boundary map:
+        grandparent = parent.parent_ids[0]
+        commit = self.rewrite_head({parent.hex: grandparent.hex})
+        self.assertEqual(commit.parent_ids, [grandparent])
+        self.assertEqual(commit.tree_id, head.tree_id)
+        self.assertEqual(commit.message, head.message)
+
+
+class CountingDos2Unix(Dos2Unix):
+
+    reads = []
+
+    def read_blob(self, sha1):
+        self.reads.append(sha1)
+        return super().read_blob(sha1)
+
+
+class TestContentCache(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.repo = init_test_repo(self.path)
+        master = Branch(self.repo, self.repo.head.target)
+        master.commit("Add text files", {
+            'a.txt': "dos\r\n",
+            'c.txt': "unix\n",
+            'sub': {'b.txt': "dos\r\n"},
+        })
+        self.head = master.head[0].hex
+        self.dos = self.repo.create_blob("dos\r\n").hex
+        self.unix = self.repo.create_blob("unix\n").hex
+        self.cache = os.path.join(self.path, 'content-cache')
+        CountingDos2Unix.reads = []
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def run_dos2unix(self):
+        # start over from the original history:
+        subprocess.check_call([
+            'git', '-C', self.path, 'update-ref', 'refs/heads/master',
+            self.head])
+        objmap = os.path.join(self.path, 'objmap')
+        if os.path.exists(objmap):
+            os.remove(objmap)
+        CountingDos2Unix.reads = []
+        run_filter(CountingDos2Unix, self.path,
+                   ['--content-cache=' + self.cache, '.txt'])
+        self.assertEqual(ls_files(self.path, 'master')[-3:],
+                         ['a.txt', 'c.txt', 'sub/b.txt'])
+        return sorted(CountingDos2Unix.reads)
+
+    def test_once_per_blob(self):
+        # 'a.txt' and 'sub/b.txt' share the blob:
+        self.assertEqual(self.run_dos2unix(), sorted([self.dos, self.unix]))
+        master = self.repo.lookup_reference('refs/heads/master').target
+        tree = self.repo[master].tree
+        self.assertEqual(tree['a.txt'].id, self.repo[tree['sub'].id]['b.txt'].id)
+        self.assertEqual(self.repo[tree['a.txt'].id].data, b"dos\n")
+
+    def test_reuse(self):
+        self.run_dos2unix()
+        self.assertEqual(self.run_dos2unix(), [])
+
+    def test_missing_result(self):
+        with open(self.cache, 'w') as f:
+            f.write(json.dumps(['convertToUnix', self.dos, '0'*40]) + '\n')
+            f.write(json.dumps(['convertToUnix', self.unix, self.unix]) + '\n')
+        self.assertEqual(self.run_dos2unix(), [self.dos])
+
+
+class TestPrefetch(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.repo = init_test_repo(self.path)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        shutil.rmtree(self.path)
+
+    def prefetch(self, instance):
+        instance.object_cache = ObjectCache(100)
+        queue = SimpleNamespace(num_total=1, num_pending=0,
+                                progress=asyncio.Event())
+        head = self.repo.head.target.hex
+        self.loop.run_until_complete(instance.prefetch_roots(queue, [head]))
+        tree = self.repo[head].tree
+        trees = {
+            'root': tree.hex,
+            'nested': tree['nested'].hex,
+            'subdir': self.repo[tree['nested'].id]['subdir'].hex,
+            'sibling': tree['sibling'].hex,
+        }
+        return sorted(k for k, v in trees.items() if v in instance.object_cache)
+
+    def test_should_descend(self):
+        with chdir(self.path):
+            self.assertEqual(self.prefetch(TreeFilter()),
+                             ['nested', 'root', 'sibling', 'subdir'])
+            self.assertEqual(self.prefetch(Rm('nested/subdir')),
+                             ['nested', 'root'])
+            self.assertEqual(self.prefetch(Rm('sibling/*')),
+                             ['root', 'sibling'])
+            treemap = os.path.join(self.path, 'treemap')
+            open(treemap, 'w').close()
+            self.assertEqual(self.prefetch(Dir2Mod(treemap, 'nested', 'url')),
+                             ['root'])
+
+    def test_failure(self):
+        async def rewrite(obj):
+            await asyncio.sleep(0.01)
+        async def prefetch(queue, objs):
+            raise RuntimeError("broken")
+        stdout = StringIO()
+        with unittest.mock.patch('sys.stdout', stdout):
+            self.loop.run_until_complete(process_objects(
+                2, rewrite, ['a', 'b'], prefetch=prefetch,
+                progress=Progress(None, Counter(), '')))
+        self.assertIn("Prefetching failed: RuntimeError('broken')",
+                      stdout.getvalue())
+
+
+class SmallChunks(Unpack):
+
+    chunk_size = 8
+    calls = Counter()
+
+    def update_tree(self, base, removed, added):
+        self.calls['update_tree'] += 1
+        return super().update_tree(base, removed, added)
+
+    def write_tree(self, entries):
+        self.calls['write_tree'] += 1
+        return super().write_tree(entries)
+
+
+class TestLargeTrees(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.repo = init_test_repo(self.path)
+        SmallChunks.calls.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def commit(self, tree):
+        master = Branch(self.repo, self.repo.head.target)
+        master.commit("Update", tree)
+
+    def master_tree(self):
+        return self.repo[self.repo.lookup_reference(
+            'refs/heads/master').target].tree_id
+
+    def test_chunks(self):
+        tree = {'f{:02}'.format(i): "{}\n".format(i) for i in range(50)}
+        self.commit(dict(tree, **{
+            'g{}.gz'.format(i): gzip('g', "g{}\n".format(i))
+            for i in range(3)}))
+        run_filter(SmallChunks, self.path, [])
+        # same as building the whole tree from scratch:
+        expected = create_tree(self.repo, dict(tree, **{
+            'g{}'.format(i): "g{}\n".format(i) for i in range(3)}))
+        self.assertEqual(self.master_tree(), expected)
+        self.assertEqual(SmallChunks.calls['write_tree'], 0)
+
+    def test_collision(self):
+        # the unpacked 'f1.gz' replaces the unchanged 'f1':
+        self.commit({
+            'f0': "f0\n",
+            'f1': "old\n",
+            'f1.gz': gzip('f1', "new\n"),
+            'f2': "f2\n",
+        })
+        run_filter(SmallChunks, self.path, [])
+        expected = create_tree(self.repo, {
+            'f0': "f0\n", 'f1': "new\n", 'f2': "f2\n"})
+        self.assertEqual(self.master_tree(), expected)
+        self.assertEqual(SmallChunks.calls['write_tree'], 1)
+
+
+class TestRm(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.repo = init_test_repo(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def add_attributes(self):
+        master = Branch(self.repo, self.repo.head.target)
+        master.commit("Add attributes", {
+            '.gitattributes': "nested/subdir/*.gz -diff\n*.txt text\n",
+            'nested': {
+                '.gitattributes': "subdir/** -diff\n# comment\n",
+                'subdir': {
+                    'data.gz': gzip('data', "data\n"),
+                    'small file': "small\n",
+                },
+            },
+            'sibling': {'a.txt': "text\n"},
+        })
+
+    def show(self, path):
+        return subprocess.check_output([
+            'git', '-C', self.path, 'show', 'master:' + path,
+        ]).decode('utf-8')
+
+    def test_index(self):
+        run_filter(Index, self.path, [])
+        run_filter(Rm, self.path, ['sibling'])
+        self.assertEqual(ls_files(self.path, 'master'), [
+            'nested/subdir/large file.gz', 'nested/subdir/small file'])
+
+    def check_remove_dir(self):
+        run_filter(Rm, self.path, ['nested/subdir'])
+        self.assertEqual(ls_files(self.path, 'master'), [
+            '.gitattributes', 'nested/.gitattributes', 'sibling/a.txt'])
+        self.assertEqual(self.show('.gitattributes'), "*.txt text")
+        self.assertEqual(self.show('nested/.gitattributes'), "# comment")
+
+    def test_remove_dir(self):
+        self.add_attributes()
+        self.check_remove_dir()
+
+    def test_remove_dir_with_index(self):
+        self.add_attributes()
+        run_filter(Index, self.path, [])
+        self.check_remove_dir()
+
+    def test_remove_root(self):
+        objmap = os.path.join(self.path, 'objmap')
+        for pattern in ['**', '/', '', '**/', '/**/**']:
+            with self.assertRaises(ValueError):
+                run_filter(Rm, self.path, [pattern])
+        self.assertFalse(os.path.exists(objmap))
+        run_filter(Rm, self.path, ['*'])
+        self.assertEqual(ls_files(self.path, 'master'), [])
+
+    def test_remove_glob(self):
+        self.add_attributes()
+        run_filter(Rm, self.path, ['**/*.gz'])
+        self.assertEqual(ls_files(self.path, 'master'), [
+            '.gitattributes', 'nested/.gitattributes',
+            'nested/subdir/small file', 'sibling/a.txt'])
+        self.assertEqual(self.show('.gitattributes'), "*.txt text")
+        self.assertEqual(self.show('nested/.gitattributes'),
+                         "subdir/** -diff\n# comment\n")
+
+
+class TestBigFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.repo = init_test_repo(self.path)
+        master = Branch(self.repo, self.repo.head.target)
+        master.commit("Add a big file", {
+            'big.bin': "x" * 5000,
+            'small.txt': "small\n",
+        })
+        self.big = self.repo.create_blob("x" * 5000).hex
+        self.report = os.path.join(self.path, 'bigfiles-report')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def read_report(self):
+        with open(self.report) as f:
+            return f.read().splitlines()
+
+    def test_parse_size(self):
+        self.assertEqual(parse_size('100'), 100)
+        self.assertEqual(parse_size('4k'), 4096)
+        self.assertEqual(parse_size('2M'), 2 * 1024**2)
+        self.assertEqual(parse_size('1G'), 1024**3)
+        self.assertRaises(ValueError, parse_size, 'big')
+
+    def test_large_blobs(self):
+        with chdir(self.path):
+            self.assertEqual(large_blobs(60000), {})
+            self.assertIn(self.big, large_blobs(4096))
+        empty = tempfile.mkdtemp()
+        try:
+            with chdir(empty), self.assertRaises(subprocess.CalledProcessError):
+                large_blobs(4096)
+        finally:
+            shutil.rmtree(empty)
+
+    def test_remove(self):
+        run_filter(BigFiles, self.path, ['4k'])
+        self.assertEqual(ls_files(self.path, 'master'), ['small.txt'])
+        self.assertIn('{} 5000 big.bin'.format(self.big), self.read_report())
+
+    def test_stub(self):
+        run_filter(BigFiles, self.path, ['4k', 'stub'])
+        self.assertEqual(ls_files(self.path, 'master'), ['big.bin', 'small.txt'])
+        blob = subprocess.check_output([
+            'git', '-C', self.path, 'show', 'master:big.bin'])
+        self.assertEqual(blob.decode('utf-8'), STUB.format(self.big, 5000))
+
+    def test_keep_report(self):
+        with open(self.report, 'w') as f:
+            f.write('previous\n')
+        open(os.path.join(self.path, 'objmap'), 'w').close()
+        run_filter(BigFiles, self.path, ['4k'])
+        self.assertEqual(self.read_report(), ['previous'])
+
+
+class TestLFS(unittest.TestCase):
+
+    attributes = "*.txt text\n*.bin filter=lfs diff=lfs merge=lfs -text\n"
+    pointer = POINTER.format('0'*64, 42)
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.repo = init_test_repo(self.path)
+        master = Branch(self.repo, self.repo.head.target)
+        master.commit("Add binary files", {
+            '.gitattributes': self.attributes,
+            'data.bin': "binary\n" * 1000,
+            'pointer.bin': self.pointer,
+            'readme.txt': "text\n",
+            'assets': {
+                'a.psd': "psd\n",
+                'sub': {'b.psd': "nested psd\n"},
+            },
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def show(self, path):
+        return subprocess.check_output([
+            'git', '-C', self.path, 'show', 'master:' + path,
+        ]).decode('utf-8')
+
+    def check_converted(self, path, text):
+        oid = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        self.assertEqual(self.show(path), POINTER.format(oid, len(text)))
+        store = os.path.join(
+            self.path, 'lfs', 'objects', oid[0:2], oid[2:4], oid)
+        with open(store) as f:
+            self.assertEqual(f.read(), text)
+
+    def test_convert(self):
+        run_filter(LFS, self.path, ['*.bin', 'assets/*.psd'])
+        self.check_converted('data.bin', "binary\n" * 1000)
+        self.check_converted('assets/a.psd', "psd\n")
+        self.assertEqual(self.show('assets/sub/b.psd'), "nested psd\n")
+        self.assertEqual(self.show('readme.txt'), "text\n")
+        self.assertEqual(self.show('pointer.bin'), self.pointer)
+        self.assertEqual(self.show('.gitattributes'), self.attributes +
+                         "assets/*.psd filter=lfs diff=lfs merge=lfs -text\n")
+        self.assertEqual(os.listdir(os.path.join(self.path, 'lfs', 'tmp')), [])
+
+    def test_cleanup(self):
+        with self.assertRaises(subprocess.CalledProcessError):
+            store_lfs_object(self.repo, '0'*40)
+        self.assertEqual(os.listdir(os.path.join(self.path, 'lfs', 'tmp')), [])
+
+
+class TestTreeIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.file = os.path.join(self.path, 'tree-index')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_skip(self):
+        keys = [ext_key('.gz'), name_key('.gitattributes')]
+        with TreeIndex(self.file, keys) as index:
+            index.add_tree('a'*40, [(0o100644, 'blob', 'b'*40, 'foo.txt')])
+            index.add_tree('c'*40, [(0o100644, 'blob', 'd'*40, 'foo.tar.gz')])
+            index.add_tree('e'*40, [(0o040000, 'tree', 'a'*40, 'sub'),
+                                    (0o040000, 'tree', 'c'*40, 'gz')])
+            index.add_tree('f'*40, [(0o040000, 'tree', '0'*40, 'unknown')])
+            self.assertTrue(index.skip('a'*40))
+            self.assertFalse(index.skip('c'*40))
+            self.assertFalse(index.skip('e'*40))
+            self.assertFalse(index.skip('f'*40))
+            self.assertTrue(index.skip_name('foo.txt'))
+            self.assertFalse(index.skip_name('foo.tar.gz'))
+            self.assertFalse(index.skip_name('.gitattributes'))
+        # reload from disk:
+        index = TreeIndex(self.file, [name_key('foo.txt')])
+        self.assertEqual(sorted(index.summaries), ['a'*40, 'c'*40, 'e'*40])
+        self.assertFalse(index.skip('a'*40))
+        self.assertTrue(index.skip('c'*40))
+        self.assertFalse(TreeIndex(self.file).skip('a'*40))
+
+    def test_sizes(self):
+        def blobs(prefix, num):
+            return [(0o100644, 'blob', 'b'*40, '{}{}.c'.format(prefix, i))
+                    for i in range(num)]
+        def trees(*sha1s):
+            return [(0o040000, 'tree', sha1, str(i))
+                    for i, sha1 in enumerate(sha1s)]
+        keys = [name_key('missing.c'), ext_key('.gz')]
+        with TreeIndex(self.file, keys) as index:
+            index.add_tree('1'*40, blobs('a', 10))
+            index.add_tree('2'*40, blobs('b', 2000))
+            index.add_tree('3'*40, trees('1'*40, '2'*40))
+            index.add_tree('4'*40, blobs('c', 20000))
+            index.add_tree('5'*40, trees('3'*40, '4'*40))
+        with open(self.file) as f:
+            lines = dict(line.split() for line in f.readlines()[1:])
+        # small trees store few bytes, larger trees stay skippable:
+        self.assertLess(len(lines['1'*40]), 200)
+        self.assertLess(len(lines['3'*40]), 5000)
+        self.assertEqual(lines['5'*40], 'full')
+        index = TreeIndex(self.file, keys)
+        for sha1 in '123':
+            self.assertTrue(index.skip(sha1*40))
+        self.assertFalse(index.skip('5'*40))
+        # no false negatives:
+        self.assertFalse(TreeIndex(self.file, [name_key('b7.c')]).skip('3'*40))
+        self.assertFalse(TreeIndex(self.file, [name_key('a7.c')]).skip('3'*40))
+
+
+class TestPathMatcher(unittest.TestCase):
+
+    def test_match(self):
+        matcher = PathMatcher([
+            'secret.txt', 'vendor/lib', 'conf/*.pem', '**/id_rsa', 'a/**/b'])
+        self.assertTrue(matcher.match('secret.txt'))
+        self.assertFalse(matcher.match('sub/secret.txt'))
+        self.assertTrue(matcher.match('vendor/lib'))
+        self.assertTrue(matcher.match('vendor/lib/x/y.c'))
+        self.assertFalse(matcher.match('vendor/other'))
+        self.assertTrue(matcher.match('conf/key.pem'))
+        self.assertFalse(matcher.match('conf/key.txt'))
+        self.assertTrue(matcher.match('id_rsa'))
+        self.assertTrue(matcher.match('home/user/.ssh/id_rsa'))
+        self.assertTrue(matcher.match('a/b'))
+        self.assertTrue(matcher.match('a/x/y/b'))
+        self.assertFalse(matcher.match('a/x/y/c'))
+
+    def test_prune(self):
+        matcher = PathMatcher(['vendor/lib', 'conf/*.pem'])
+        self.assertTrue(matcher.state('vendor'))
+        self.assertFalse(matcher.state('src'))
+        self.assertFalse(matcher.state('vendor/other'))
+        self.assertFalse(matcher.state('conf/sub'))
+        self.assertTrue(PathMatcher(['**/x']).state('src/deep'))
+
+    def test_not_recursive(self):
+        matcher = PathMatcher(['assets/*.psd', 'data/**'], recursive=False)
+        self.assertTrue(matcher.match('assets/a.psd'))
+        self.assertFalse(matcher.match('assets/sub/b.psd'))
+        self.assertFalse(matcher.match('assets/a.psd/c'))
+        self.assertTrue(matcher.match('data/x/y'))
+
+    def test_memo(self):
+        matcher = PathMatcher(['conf/*.pem'])
+        self.assertTrue(matcher.match('conf/key.pem'))
+        self.assertFalse(matcher.match('src/main/app.c'))
+        self.assertEqual(sorted(matcher._states),
+                         ['', 'conf', 'src', 'src/main'])
+
+
+class TestProgress(unittest.TestCase):
+
+    def test_json_events(self):
+        stream = StringIO()
+        stats = Counter()
+        progress = Progress(JSONRenderer(stream), stats, 'trees', interval=0)
+        progress.start(100)
+        queue = SimpleNamespace(num_done=0, num_pending=100)
+        for new in [100] * 10 + [10] * 20:
+            stats['rewrite_object', 'misses'] += new
+            stats['rewrite_object', 'done'] += new
+            queue.num_done += 1
+            queue.num_pending -= 1
+            progress.update(queue)
+        progress.finish(queue)
+        events = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual([e['event'] for e in events],
+                         ['start'] + ['progress'] * 30 + ['finish'])
+        last = events[-1]
+        self.assertEqual(last['roots_done'], 30)
+        self.assertEqual(last['objects_done'], 1200)
+        # remaining estimate follows the recent roots, not the average root:
+        self.assertLess(last['objects_remaining'], 0.75 * 70 * 1200 / 30)
+
+    def test_streams(self):
+        stdout, stderr = StringIO(), StringIO()
+        # streams are looked up when rendering:
+        with unittest.mock.patch('sys.stdout', stdout), \
+                unittest.mock.patch('sys.stderr', stderr):
+            renderer = make_renderer('auto')
+            self.assertIsInstance(renderer, JSONRenderer)
+            renderer('start', {})
+            TTYRenderer()('finish', dict(
+                roots_done=1, roots_total=1, objects_done=1, rate=1.0,
+                elapsed=1, eta=None))
+        self.assertEqual(json.loads(stderr.getvalue()), {'event': 'start'})
+        self.assertIn('1 / 1 roots', stdout.getvalue())
+
+    def test_progress_file(self):
+        path = tempfile.mkdtemp()
+        try:
+            init_test_repo(path)
+            progress = os.path.join(path, 'progress')
+            run_filter(Index, path, [
+                '--progress=auto', '--progress-file=' + progress])
+            with open(progress) as f:
+                events = [json.loads(line)['event'] for line in f]
+            self.assertEqual(events[0], 'start')
+            self.assertEqual(events[-1], 'finish')
+        finally:
+            shutil.rmtree(path)
+
+
+class TestEager(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_sync(self):
+        async def nop(x):
+            return x
+        future = eager(nop(42))
+        self.assertTrue(future.done())
+        self.assertEqual(future.result(), 42)
+
+    def test_async(self):
+        async def sleepy(x):
+            await asyncio.sleep(0)
+            await asyncio.sleep(0.01)
+            return x
+        async def main():
+            future = eager(sleepy(42))
+            self.assertFalse(future.done())
+            return await future
+        self.assertEqual(self.loop.run_until_complete(main()), 42)
+
+    def test_exception(self):
+        async def fail():
+            await asyncio.sleep(0)
+            raise ValueError
+        async def main():
+            with self.assertRaises(ValueError):
+                await eager(fail())
+        self.loop.run_until_complete(main())
+
+
 if __name__ == '__main__':
     unittest.main()